@@ -0,0 +1,80 @@
+"""
+大量の行をまとめて処理するバックフィル用 CLI（Flask ルートを通さない）
+
+    python backfill.py --stages pvq,big5,color --start-row 2 --end-row 20001
+    python backfill.py --input export.parquet --output backfilled.parquet
+
+スプレッドシート入力時は SPREADSHEETS に設定した全シートの行を 1 つのキューにまとめ、
+同じスレッドプール・プロセスプール・類似バリュー索引で処理する（行範囲は各シート共通）。
+LLM 呼び出しはスレッドプール、PDF の色抽出はプロセスプールで並列に実行し、
+結果はチャンクごとにまとめて書き戻す（処理本体は Flask の各ステージと共有）。
+LEASE_BACKEND を設定するとチャンクごとに行をリースし、リースした行はシートから読み直して
+他のワーカーが書き込み済みならスキップする（起動時に読んだ DataFrame は数時間古くなり、
+リースも TTL で切れるため）。完了済みの行は未処理判定でスキップされるので、
+途中で止めても同じコマンドで再開できる（ファイル入力時は --output があればそちらから再開）。
+"""
+import argparse
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from read_coデータ import open_worksheets
+from update_co心理指標 import TRAIT_STAGES, run_trait_stage
+from update_co色 import run_color_stage
+from co入出力 import SheetTarget, FileTarget, MultiTarget
+
+
+ALL_STAGES = [*TRAIT_STAGES, "color"]
+
+
+# ============================================
+# エントリポイント
+# ============================================
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="PVQ / Big5 / 色番号のバックフィル")
+    parser.add_argument("--stages", default=",".join(ALL_STAGES),
+                        help="実行するステージ（カンマ区切り: pvq,big5,color）")
+    parser.add_argument("--start-row", type=int, default=2, help="開始行（シートの行番号）")
+    parser.add_argument("--end-row", type=int, default=None, help="終了行（この行を含む）")
+    parser.add_argument("--input", default=None,
+                        help="CSV / Parquet の入力ファイル（省略時はスプレッドシート）")
+    parser.add_argument("--output", default=None, help="ファイル入力時の出力先（省略時は上書き）")
+    parser.add_argument("--chunk-size", type=int, default=200, help="まとめて書き戻す行数")
+    parser.add_argument("--llm-workers", type=int, default=8)
+    parser.add_argument("--download-workers", type=int, default=16)
+    parser.add_argument("--color-workers", type=int, default=os.cpu_count())
+    args = parser.parse_args(argv)
+
+    args.stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = set(args.stages) - set(ALL_STAGES)
+    if unknown:
+        parser.error(f"不明なステージ: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args(argv)
+
+    targets = [FileTarget(args.input, args.output)] if args.input else [SheetTarget(ws) for _, ws in open_worksheets()]
+    target = MultiTarget(targets)
+    df = target.load()
+
+    end = target.row_numbers.max(initial=1) if args.end_row is None else args.end_row
+    in_range = (target.row_numbers >= args.start_row) & (target.row_numbers <= end)
+
+    # プールは全シート・全ステージで共有する
+    with ThreadPoolExecutor(max_workers=args.llm_workers) as llm_pool, \
+            ThreadPoolExecutor(max_workers=args.download_workers) as downloads, \
+            ProcessPoolExecutor(max_workers=args.color_workers) as extractors:
+        for stage in args.stages:
+            if stage == "color":
+                run_color_stage(target, df, in_range, downloads, extractors, args.chunk_size)
+            else:
+                run_trait_stage(stage, target, df, in_range, llm_pool, args.chunk_size)
+
+    logging.info(f"✅ バックフィル完了（{len(targets)} シート）")
+
+
+if __name__ == "__main__":
+    main()
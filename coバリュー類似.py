@@ -0,0 +1,76 @@
+import os
+
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+
+# この値以上のコサイン類似度なら同じバリューとみなす（1 より大きくすると無効）
+DEFAULT_SIMILARITY_THRESHOLD = 0.95
+
+# 類似度行列を一度に計算する行数（上限）。1 ブロックの要素数が BLOCK_ELEMENTS を
+# 超えないよう、行数が多いときはさらに小さくする
+CHUNK_SIZE = 512
+BLOCK_ELEMENTS = 4_000_000
+
+
+def similarity_threshold():
+    value = os.getenv("VALUE_SIMILARITY_THRESHOLD")
+    if not value:
+        return DEFAULT_SIMILARITY_THRESHOLD
+    return float(value)
+
+
+# ============================================
+# 類似バリューの代表行を求める
+# ============================================
+def find_representatives(texts, reusable, pending, threshold=None):
+    """
+    pending の各行について、スコアを流用できる代表行の index を返す。
+    代表行は reusable（推定済み）の行か、自分より前にある pending の行。
+    似た行がなければ自分自身が代表になる（rep[i] == i）。
+    """
+    if threshold is None:
+        threshold = similarity_threshold()
+
+    texts = np.asarray(texts, dtype=object)
+    reusable = np.asarray(reusable, dtype=bool)
+    pending = np.asarray(pending, dtype=bool)
+    rep = np.arange(len(texts))
+
+    pending_rows = np.flatnonzero(pending)
+    if threshold > 1 or len(pending_rows) == 0:
+        return rep
+
+    # 文字 n-gram の TF-IDF（日本語は分かち書きしない）
+    candidates = np.flatnonzero(reusable | pending)
+    try:
+        matrix = TfidfVectorizer(
+            analyzer="char_wb", ngram_range=(2, 3), dtype=np.float32
+        ).fit_transform(
+            [str(t) for t in texts[candidates]]
+        )
+    except ValueError:
+        # 語彙が作れない（記号だけ等）場合は流用しない
+        return rep
+    position = np.full(len(texts), -1)
+    position[candidates] = np.arange(len(candidates))
+
+    is_rep = reusable[candidates].copy()
+
+    # 類似度は疎行列のまま扱い、行ごとに非ゼロ要素だけから最良の代表行を選ぶ
+    chunk_size = max(1, min(CHUNK_SIZE, BLOCK_ELEMENTS // len(candidates)))
+    for start in range(0, len(pending_rows), chunk_size):
+        block = pending_rows[start:start + chunk_size]
+        sims = (matrix[position[block]] @ matrix.T).tocsr()
+        sims.sort_indices()
+
+        for k, row in enumerate(block):
+            cols = sims.indices[sims.indptr[k]:sims.indptr[k + 1]]
+            sim = sims.data[sims.indptr[k]:sims.indptr[k + 1]]
+            ok = is_rep[cols] & (sim >= threshold)
+            if ok.any():
+                rep[row] = candidates[cols[ok][sim[ok].argmax()]]
+            else:
+                is_rep[position[row]] = True
+
+    return rep
@@ -0,0 +1,201 @@
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+from gspread_dataframe import get_as_dataframe
+
+from co列型 import write_columns
+from co行リース import claim_rows
+
+
+# ============================================
+# 列 index → A1 記法
+# ============================================
+def col_to_letter(index):
+    letters = ""
+    while index >= 0:
+        index, rem = divmod(index, 26)
+        letters = chr(65 + rem) + letters
+        index -= 1
+    return letters
+
+
+# ============================================
+# 入出力先（スプレッドシート / ローカルファイル / 複数シート）
+# load / add_columns / claim / write を共通の形で持つ
+# ============================================
+class SheetTarget:
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+
+    def load(self):
+        return get_as_dataframe(self.worksheet)
+
+    def sources(self, df):
+        """各行の出どころ（参照元列で別シートの行を指すときに添える）"""
+        label = f"{self.worksheet.spreadsheet.id} / {self.worksheet.title}"
+        return np.full(len(df), label, dtype=object)
+
+    def add_columns(self, df, columns):
+        for col in columns:
+            if col not in df.columns:
+                df[col] = ""
+                self.worksheet.update(f"{col_to_letter(df.columns.get_loc(col))}1", [[col]])
+
+    def claim(self, stage, df, candidates, limit=None):
+        """シャーディング時はリースを取れた行だけに絞る（無効時は candidates のまま）"""
+        return claim_rows(self.worksheet, stage, df, candidates, limit)
+
+    def refresh(self, df, rows, columns):
+        """rows の columns をシートから読み直して df に反映する（他のワーカーの書き込みを拾う）"""
+        positions = [df.columns.get_loc(col) for col in columns]
+        first, last = min(positions), max(positions)
+        runs = np.split(rows, np.flatnonzero(np.diff(rows) != 1) + 1)
+        fetched = self.worksheet.batch_get([
+            f"{col_to_letter(first)}{run[0] + 2}:{col_to_letter(last)}{run[-1] + 2}"
+            for run in runs
+        ])
+
+        for col, p in zip(columns, positions):
+            column = df[col].to_numpy(dtype=object).copy()
+            for run, values in zip(runs, fetched):
+                for k, i in enumerate(run):
+                    row = values[k] if k < len(values) else []
+                    column[i] = row[p - first] if p - first < len(row) else ""
+            df[col] = column
+
+    def write(self, df, cells, rows):
+        """cells は {列名: [[値] or None, ...]}。rows の行だけを書き戻す"""
+        write_columns(
+            self.worksheet,
+            [(col_to_letter(df.columns.get_loc(col)), c) for col, c in cells.items()],
+            np.asarray(rows),
+        )
+
+
+class FileTarget:
+    def __init__(self, input_path, output_path):
+        self.input_path = input_path
+        self.output_path = output_path or input_path
+
+    def load(self):
+        # 出力ファイルがあれば途中結果から再開する
+        path = self.output_path if os.path.exists(self.output_path) else self.input_path
+        if path.endswith(".parquet"):
+            return pd.read_parquet(path)
+        return pd.read_csv(path)
+
+    def sources(self, df):
+        return np.full(len(df), self.input_path, dtype=object)
+
+    def add_columns(self, df, columns):
+        for col in columns:
+            if col not in df.columns:
+                df[col] = ""
+
+    def claim(self, stage, df, candidates, limit=None):
+        return candidates   # ローカルファイルは共有しないのでリース不要
+
+    def refresh(self, df, rows, columns):
+        pass   # 他のワーカーが書き込むことはない
+
+    def write(self, df, cells, rows):
+        for col, c in cells.items():
+            column = df[col].to_numpy(dtype=object).copy()
+            column[rows] = [c[r][0] for r in rows]
+            df[col] = column
+
+        if self.output_path.endswith(".parquet"):
+            # parquet は列の型を揃える必要があるので文字列で保存する
+            out = df.astype(object).where(df.notna(), "").astype(str)
+            out.to_parquet(self.output_path, index=False)
+        else:
+            df.to_csv(self.output_path, index=False)
+
+
+class MultiTarget:
+    """複数の入出力先の行を 1 つの DataFrame にまとめ、リース・書き戻しは各シートへ振り分ける"""
+
+    def __init__(self, targets):
+        self.targets = targets
+        self.parts = []
+        self.row_numbers = np.array([], dtype=int)
+
+    def load(self):
+        offset = 0
+        for target in self.targets:
+            part = target.load()
+            self.parts.append((target, part, offset))
+            offset += len(part)
+
+        if not self.parts:
+            return pd.DataFrame()
+
+        # 各行の元シートでの行番号（--start-row / --end-row はこれで判定）
+        self.row_numbers = np.concatenate([np.arange(len(p)) + 2 for _, p, _ in self.parts])
+        return pd.concat([p for _, p, _ in self.parts], ignore_index=True)
+
+    def sources(self, df):
+        if not self.parts:
+            return np.array([], dtype=object)
+        return np.concatenate([target.sources(part) for target, part, _ in self.parts])
+
+    def add_columns(self, df, columns):
+        for target, part, _ in self.parts:
+            target.add_columns(part, columns)
+        for col in columns:
+            if col not in df.columns:
+                df[col] = ""
+
+    def claim(self, stage, df, candidates, limit=None):
+        mask = np.zeros(len(df), dtype=bool)
+        for target, part, offset in self.parts:
+            local = candidates[offset:offset + len(part)]
+            if local.any():
+                mask[offset:offset + len(part)] = target.claim(stage, part, local, limit)
+        return mask
+
+    def refresh(self, df, rows, columns):
+        for target, part, offset in self.parts:
+            local = rows[(rows >= offset) & (rows < offset + len(part))] - offset
+            if len(local) == 0:
+                continue
+            target.refresh(part, local, columns)
+            for col in columns:
+                column = df[col].to_numpy(dtype=object).copy()
+                column[local + offset] = part[col].to_numpy(dtype=object)[local]
+                df[col] = column
+
+    def write(self, df, cells, rows):
+        rows = np.asarray(rows)
+        for target, part, offset in self.parts:
+            local = rows[(rows >= offset) & (rows < offset + len(part))] - offset
+            if len(local) == 0:
+                continue
+            target.write(
+                part,
+                {col: c[offset:offset + len(part)] for col, c in cells.items()},
+                local,
+            )
+
+
+# ============================================
+# リース後の再確認（古い DataFrame で処理済みの行を取り直さない）
+# ============================================
+def drop_finished(target, df, rows, columns, load, values, status, extra_columns=()):
+    """
+    リースした rows の columns（と extra_columns）を読み直し、読み込み時から変わっていない行だけを返す。
+    リースは TTL で切れるので、読み込みが古いと他のワーカーが書き込み済みの行も取れてしまう。
+    変わっていた行は values / status をシートの内容に合わせてから除く。
+    """
+    target.refresh(df, rows, list(columns) + list(extra_columns))
+    fresh_values, fresh_status = load(df.iloc[rows], columns)
+    unchanged = (fresh_values == values[rows]).all(axis=1) & (fresh_status == status[rows])
+
+    changed = rows[~unchanged]
+    values[changed] = fresh_values[~unchanged]
+    status[changed] = fresh_status[~unchanged]
+    if len(changed):
+        logging.info(f"⏭️ 他のワーカーが処理済みのためスキップ: {len(changed)} 行")
+    return rows[unchanged]
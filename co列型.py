@@ -0,0 +1,158 @@
+import re
+from enum import IntEnum
+
+import numpy as np
+import pandas as pd
+
+
+# ============================================
+# 行の処理状態（シート上の文字列番兵に対応）
+# ============================================
+class 状態(IntEnum):
+    未処理 = 0
+    完了 = 1
+    対象外 = 2
+    取得失敗 = 3
+
+
+# 状態 → シートに書き戻す文字列
+状態文字列 = {
+    状態.未処理: "",
+    状態.完了: "",
+    状態.対象外: "対象外",
+    状態.取得失敗: "取得失敗",
+}
+
+# 値が入っていないことを表す値（特性: int8 / 色: int32）
+欠損 = -1
+
+HEX_PATTERN = re.compile(r"^#([0-9A-Fa-f]{6})$")
+
+
+def text_column(df, col):
+    """列を前後の空白を除いた文字列 Series で取り出す（列がなければ空文字）"""
+    if col not in df.columns:
+        return pd.Series("", index=df.index)
+    return df[col].astype(object).fillna("").astype(str).str.strip()
+
+
+# ============================================
+# 特性スコア列（PVQ / Big5）
+# ============================================
+def load_traits(df, columns):
+    """特性列を int8 配列 (行数, 列数) と行ごとの状態配列に変換する"""
+    n = len(df)
+    values = np.full((n, len(columns)), 欠損, dtype=np.int8)
+    texts = np.full((n, len(columns)), "", dtype=object)
+
+    for j, col in enumerate(columns):
+        text = text_column(df, col)
+        num = pd.to_numeric(text, errors="coerce").to_numpy(dtype=float)
+        ok = np.isfinite(num) & (num == np.round(num)) & (num >= 0) & (num <= 127)
+        values[ok, j] = num[ok].astype(np.int8)
+        texts[:, j] = text.to_numpy()
+
+    status = np.full(n, 状態.未処理, dtype=np.uint8)
+    status[(texts == "対象外").any(axis=1)] = 状態.対象外
+    status[(texts == "取得失敗").any(axis=1)] = 状態.取得失敗
+    status[(values != 欠損).all(axis=1)] = 状態.完了
+    return values, status
+
+
+def traits_to_cells(values, status, j, rows=None):
+    """j 列目をシート書き戻し用の [[値], ...] に変換する（rows 指定時はその行だけ、他は None）"""
+    cells = [None] * len(values)
+    for i in range(len(values)) if rows is None else rows:
+        v = values[i, j]
+        cells[i] = [int(v)] if v != 欠損 else [状態文字列[状態(status[i])]]
+    return cells
+
+
+def set_traits(values, status, i, scores, columns):
+    """推定結果の dict を i 行目に書き込む（整数以外・bool は欠損のまま）"""
+    row = [scores.get(col) for col in columns]
+    values[i] = [v if type(v) is int and 0 <= v <= 127 else 欠損 for v in row]
+    status[i] = 状態.完了 if (values[i] != 欠損).all() else 状態.未処理
+
+
+# ============================================
+# 色列（#RRGGBB を 0xRRGGBB に詰める）
+# ============================================
+def pack_rgb(hex_str):
+    if not isinstance(hex_str, str) or not HEX_PATTERN.match(hex_str.strip()):
+        return 欠損
+    return int(hex_str.strip()[1:], 16)
+
+
+def unpack_rgb(packed):
+    """0xRRGGBB 配列 → (…, 3) の 0〜1 float 配列"""
+    packed = np.asarray(packed, dtype=np.int64)
+    rgb = np.stack([(packed >> 16) & 0xFF, (packed >> 8) & 0xFF, packed & 0xFF], axis=-1)
+    return rgb / 255
+
+
+def rgb_to_hex(packed):
+    return f"#{int(packed):06X}"
+
+
+def load_colors(df, columns):
+    """色列を int32 配列 (行数, 列数) と行ごとの状態配列に変換する"""
+    n = len(df)
+    values = np.full((n, len(columns)), 欠損, dtype=np.int32)
+    texts = np.full((n, len(columns)), "", dtype=object)
+
+    for j, col in enumerate(columns):
+        text = text_column(df, col)
+        values[:, j] = [pack_rgb(t) for t in text]
+        texts[:, j] = text.to_numpy()
+
+    # 1 列でも空なら未処理、それ以外の番兵は対象外／取得失敗として扱う
+    status = np.full(n, 状態.取得失敗, dtype=np.uint8)
+    status[(texts == "対象外").any(axis=1)] = 状態.対象外
+    status[(values != 欠損).all(axis=1)] = 状態.完了
+    status[(texts == "").any(axis=1)] = 状態.未処理
+    return values, status
+
+
+def colors_to_cells(values, status, j, rows=None):
+    cells = [None] * len(values)
+    for i in range(len(values)) if rows is None else rows:
+        v = values[i, j]
+        cells[i] = [rgb_to_hex(v)] if v != 欠損 else [状態文字列[状態(status[i])]]
+    return cells
+
+
+# ============================================
+# 対象外判定（会社名・バリュー）
+# ============================================
+def excluded_mask(df):
+    """会社名が対象外、またはバリューが空／番兵の行"""
+    company = text_column(df, "会社名")
+    value = text_column(df, "バリュー")
+    return ((company == "対象外") | value.isin(["対象外", "取得失敗", ""])).to_numpy()
+
+
+# ============================================
+# シートへの書き戻し
+# ============================================
+def write_columns(worksheet, columns, rows=None):
+    """
+    [(列記号, [[値], ...]), ...] を 2 行目から書き戻す。
+    rows を指定した場合はその行だけを書く（他のワーカーの行を上書きしない）。
+    """
+    if rows is None:
+        for letter, cells in columns:
+            worksheet.update(f"{letter}2:{letter}{len(cells) + 1}", cells)
+        return
+
+    data = []
+    for run in np.split(rows, np.flatnonzero(np.diff(rows) != 1) + 1):
+        if len(run) == 0:
+            continue
+        for letter, cells in columns:
+            data.append({
+                "range": f"{letter}{run[0] + 2}:{letter}{run[-1] + 2}",
+                "values": cells[run[0]:run[-1] + 1],
+            })
+    if data:
+        worksheet.batch_update(data)
@@ -0,0 +1,230 @@
+import logging
+import os
+import socket
+import sqlite3
+import time
+
+import numpy as np
+import gspread
+
+from co列型 import text_column
+
+
+# ============================================
+# シャーディング設定（LEASE_BACKEND 未設定なら単一プロセスで全行を処理）
+# ============================================
+LEASE_SHEET_NAME = "行リース"
+DEFAULT_SQLITE_PATH = "/tmp/row_leases.sqlite3"
+DEFAULT_BATCH_SIZE = 50
+DEFAULT_TTL_SECONDS = 600   # gunicorn のタイムアウトに合わせる
+
+
+def worker_id():
+    return os.getenv("WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+
+def row_keys(worksheet, df):
+    """
+    行を識別するキー（スプレッドシート ID / シート名 / URL、URL がなければ行番号）。
+    複数のスプレッドシートで同じリース表を共有しても衝突しないようにシートで区切る。
+    """
+    prefix = f"{worksheet.spreadsheet.id}/{worksheet.title}/"
+    urls = text_column(df, "URL").to_numpy()
+    return np.array(
+        [prefix + (url if url else f"行{i + 2}") for i, url in enumerate(urls)], dtype=object
+    )
+
+
+# ============================================
+# SQLite のリース表（ローカル・テスト用）
+# ============================================
+class SQLiteLeaseStore:
+    def __init__(self, path):
+        self.path = path
+        conn = self._connect()
+        try:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS leases ("
+                "stage TEXT, key TEXT, owner TEXT, expires REAL, "
+                "PRIMARY KEY (stage, key))"
+            )
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def claim(self, stage, keys, limit, ttl, owner):
+        now = time.time()
+        conn = self._connect()
+        try:
+            # 書き込みロックを取ってから空き行を選ぶ（他ワーカーと重ならない）
+            conn.execute("BEGIN IMMEDIATE")
+            # 自分のリースは取り直せる（期限を延ばす）
+            held = {
+                key for (key,) in conn.execute(
+                    "SELECT key FROM leases WHERE stage = ? AND expires > ? AND owner != ?",
+                    (stage, now, owner),
+                )
+            }
+            claimed = [k for k in dict.fromkeys(keys) if k not in held][:limit]
+            conn.executemany(
+                "INSERT OR REPLACE INTO leases VALUES (?, ?, ?, ?)",
+                [(stage, k, owner, now + ttl) for k in claimed],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+        return claimed
+
+
+# ============================================
+# スプレッドシートのタブをリース表にする
+# ============================================
+COMPACT_STAGE = "__compact__"
+COMPACT_MIN_ROWS = 500   # 期限切れの行がこれだけ溜まったら削除する
+
+
+class SheetLeaseStore:
+    """
+    リースは追記で取り、同じキーに複数の有効なリースがあればシート上で先の行が勝つ。
+    追記後に読み直して自分の勝ち分だけ返す（読み直した内容は次の claim の事前確認に使う）。
+    期限切れの行が溜まったら、compact 用のリースを取った 1 ワーカーだけがまとめて削除する
+    （有効な行の順序は変わらないので、他ワーカーの追記と並行しても勝敗は変わらない）。
+    """
+
+    HEADER = ["stage", "key", "owner", "expires"]
+
+    def __init__(self, spreadsheet):
+        try:
+            self.ws = spreadsheet.worksheet(LEASE_SHEET_NAME)
+        except gspread.exceptions.WorksheetNotFound:
+            try:
+                self.ws = spreadsheet.add_worksheet(title=LEASE_SHEET_NAME, rows=1000, cols=4)
+                self.ws.append_row(self.HEADER)
+            except gspread.exceptions.APIError:
+                # 他のワーカーが同時に作成した
+                self.ws = spreadsheet.worksheet(LEASE_SHEET_NAME)
+        self.rows = None
+
+    @staticmethod
+    def _expires(row):
+        try:
+            return float(row[3])
+        except (IndexError, ValueError):
+            return None
+
+    def _holders(self, stage, now):
+        holders = {}
+        for row in self.rows[1:]:
+            expires = self._expires(row)
+            if expires is not None and expires > now and row[0] == stage:
+                holders.setdefault(row[1], row[2])
+        return holders
+
+    def _append_and_check(self, stage, keys, ttl, owner):
+        now = time.time()
+        self.ws.append_rows(
+            [[stage, k, owner, now + ttl] for k in keys],
+            value_input_option="RAW",
+        )
+        self.rows = self.ws.get_all_values()
+        holders = self._holders(stage, now)
+        return [k for k in keys if holders.get(k) == owner]
+
+    def claim(self, stage, keys, limit, ttl, owner):
+        # 前回の読み直し結果で空きを見積もる（古くても追記後の確認で負けるだけ）
+        cached = self.rows is not None
+        if not cached:
+            self.rows = self.ws.get_all_values()
+        holders = self._holders(stage, time.time())
+        wanted = [k for k in dict.fromkeys(keys) if holders.get(k, owner) == owner][:limit]
+        if not wanted and cached:
+            self.rows = self.ws.get_all_values()
+            holders = self._holders(stage, time.time())
+            wanted = [k for k in dict.fromkeys(keys) if holders.get(k, owner) == owner][:limit]
+        if not wanted:
+            return []
+
+        claimed = self._append_and_check(stage, wanted, ttl, owner)
+        self._compact(ttl, owner)
+        return claimed
+
+    def _compact(self, ttl, owner):
+        def expired_rows():
+            now = time.time()
+            return [
+                n for n, row in enumerate(self.rows[1:], start=2)
+                if (self._expires(row) or 0) <= now
+            ]
+
+        if len(expired_rows()) < COMPACT_MIN_ROWS:
+            return
+        if not self._append_and_check(COMPACT_STAGE, [""], ttl, owner):
+            return
+
+        # 読み直した直後の行番号で、下の行から削除する（他ワーカーの追記は末尾なのでずれない）
+        rows = expired_rows()
+        if not rows:
+            return
+        runs = np.split(np.array(rows), np.flatnonzero(np.diff(rows) != 1) + 1)
+        self.ws.spreadsheet.batch_update({"requests": [
+            {"deleteDimension": {"range": {
+                "sheetId": self.ws.id, "dimension": "ROWS",
+                "startIndex": int(run[0]) - 1, "endIndex": int(run[-1]),
+            }}}
+            for run in reversed(runs)
+        ]})
+        self.rows = None
+        logging.info(f"🧹 期限切れのリース {len(rows)} 行を削除")
+
+
+# Flask のワーカー内で同じスプレッドシートのリース表を使い回す
+sheet_lease_stores = {}
+
+
+def open_lease_store(worksheet):
+    backend = os.getenv("LEASE_BACKEND", "")
+    if backend == "sqlite":
+        return SQLiteLeaseStore(os.getenv("LEASE_SQLITE_PATH", DEFAULT_SQLITE_PATH))
+    if backend == "sheet":
+        spreadsheet = worksheet.spreadsheet
+        if spreadsheet.id not in sheet_lease_stores:
+            sheet_lease_stores[spreadsheet.id] = SheetLeaseStore(spreadsheet)
+        return sheet_lease_stores[spreadsheet.id]
+    if backend:
+        raise RuntimeError(f"不明な LEASE_BACKEND: {backend}")
+    return None
+
+
+# ============================================
+# ステージごとに処理する行をリースする
+# ============================================
+def claim_rows(worksheet, stage, df, candidates, limit=None):
+    """
+    candidates のうちリースを取れた行だけの mask を返す（シャーディング無効時はそのまま）。
+    limit を省略すると LEASE_BATCH_SIZE 行まで取る。
+    リースは解放せず TTL で失効させる（古いシートを読んだ他ワーカーが
+    書き戻し直後の行を取り直さないようにするため）。
+    """
+    store = open_lease_store(worksheet)
+    if store is None:
+        return candidates
+
+    if limit is None:
+        limit = int(os.getenv("LEASE_BATCH_SIZE", DEFAULT_BATCH_SIZE))
+
+    keys = row_keys(worksheet, df)
+    claimed = store.claim(
+        stage,
+        keys[candidates].tolist(),
+        limit=limit,
+        ttl=float(os.getenv("LEASE_TTL_SECONDS", DEFAULT_TTL_SECONDS)),
+        owner=worker_id(),
+    )
+    mask = candidates & np.isin(keys, claimed)
+    logging.info(f"🔒 {stage}: {int(mask.sum())} / {int(candidates.sum())} 行をリース")
+    return mask
@@ -4,13 +4,14 @@ import gspread
 from gspread_dataframe import get_as_dataframe
 from google.oauth2 import service_account
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
-from read_coデータ import read_coデータ
-from update_co心理指標 import update_co個人価値観
-from update_co心理指標 import update_cobig5
-from update_co色 import update_co色番号
+from read_coデータ import open_worksheets
+from update_co心理指標 import TRAIT_STAGES, run_trait_stage
+from update_co色 import run_color_stage
 from update_co色 import update_co色
 from update_私の適合 import update_私の適合
+from co入出力 import SheetTarget, MultiTarget
 
 
 # Cloud Logging に出力するよう設定
@@ -18,19 +19,36 @@ logging.basicConfig(level=logging.INFO)
 
 app = Flask(__name__)
 
+# 全シートで共有するスレッド数（Gemini 呼び出し / PDF ダウンロード）
+LLM_WORKERS = 4
+DOWNLOAD_WORKERS = 8
+
 @app.route('/', methods=['GET', 'POST'])
 def main():
     logging.info('📥 リクエスト受信')
 
-    # スプレッドシート読込
-    worksheet, existing_df, processed_urls = read_coデータ()
+    opened = open_worksheets()
+    if not opened:
+        logging.error('❌ 開けたスプレッドシートがありません')
+        return 'エラー: 開けたスプレッドシートがありません', 500
+
+    # 全シートの行を 1 つのキューにまとめ、類似バリュー索引とスレッドプールを共有する
+    target = MultiTarget([SheetTarget(worksheet) for _, worksheet in opened])
+    df = target.load()
+
+    with ThreadPoolExecutor(max_workers=LLM_WORKERS) as llm_pool, \
+            ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as downloads:
+        for stage in TRAIT_STAGES:
+            update_count = run_trait_stage(stage, target, df, pool=llm_pool)
+            logging.info(f"📝 {stage}: {update_count} 件更新")
+        update_count = run_color_stage(target, df, downloads=downloads)
+        logging.info(f"📝 color: {update_count} 件更新")
+
+    # 塗りつぶしと相性スコアはシートごとに処理
+    for sheet, worksheet in opened:
+        update_co色(worksheet)
+        update_私の適合(worksheet, sheet['output_worksheet'])
 
-    update_co個人価値観(worksheet)
-    update_cobig5(worksheet)
-    update_co色番号(worksheet)
-    update_co色(worksheet)
-    update_私の適合(worksheet)
-    
     return 'Cloud Run Function executed.', 200
 
 
@@ -1,4 +1,6 @@
+import json
 import logging
+import os
 import pandas as pd
 import gspread
 from gspread_dataframe import get_as_dataframe
@@ -6,11 +8,55 @@ from google.oauth2 import service_account
 import time
 import numpy as np
 
-def read_coデータ():
-    SPREADSHEET_ID = '18Sb4CcAE5JPFeufHG97tLZz9Uj_TvSGklVQQhoFF28w'
-    WORKSHEET_NAME = 'バリュー抽出'
+DEFAULT_SPREADSHEET_ID = '18Sb4CcAE5JPFeufHG97tLZz9Uj_TvSGklVQQhoFF28w'
+DEFAULT_WORKSHEET_NAME = 'バリュー抽出'
+DEFAULT_OUTPUT_SHEET_NAME = '相性スコア'
 
-    try:
+gspread_client = None
+
+
+# ============================================
+# 処理対象のスプレッドシート一覧
+# ============================================
+def load_sheet_targets():
+    """
+    環境変数 SPREADSHEETS（JSON 配列）から処理対象を読む。未設定なら既定の 1 件。
+    例: [{"spreadsheet_id": "...", "worksheet": "バリュー抽出", "output_worksheet": "相性スコア"}]
+    """
+    raw = os.getenv('SPREADSHEETS')
+    entries = json.loads(raw) if raw else [{}]
+
+    return [
+        {
+            'spreadsheet_id': e.get('spreadsheet_id', DEFAULT_SPREADSHEET_ID),
+            'worksheet': e.get('worksheet', DEFAULT_WORKSHEET_NAME),
+            'output_worksheet': e.get('output_worksheet', DEFAULT_OUTPUT_SHEET_NAME),
+        }
+        for e in entries
+    ]
+
+
+def open_worksheets():
+    """
+    設定された各シートを開き (設定, worksheet) を返す（開けなかったシートはスキップ）。
+    中身は読まない（行は呼び出し側の MultiTarget.load でまとめて読む）。
+    """
+    opened = []
+    for target in load_sheet_targets():
+        try:
+            sh = get_gspread_client().open_by_key(target['spreadsheet_id'])
+            opened.append((target, sh.worksheet(target['worksheet'])))
+        except Exception as e:
+            logging.error(f"❌ シートを開けないためスキップ: {target['spreadsheet_id']} / {target['worksheet']}: {e}")
+    return opened
+
+
+# ============================================
+# gspread クライアント（全スプレッドシートで共有）
+# ============================================
+def get_gspread_client():
+    global gspread_client
+    if gspread_client is None:
         creds = service_account.Credentials.from_service_account_file(
             '/secrets/service-account-json',
             scopes=[
@@ -18,14 +64,20 @@ def read_coデータ():
                 'https://www.googleapis.com/auth/drive'
             ]
         )
-        gc = gspread.authorize(creds)
-        sh = gc.open_by_key(SPREADSHEET_ID)
-        worksheet = sh.worksheet(WORKSHEET_NAME)
+        gspread_client = gspread.authorize(creds)
+    return gspread_client
+
+
+def read_coデータ(spreadsheet_id=DEFAULT_SPREADSHEET_ID, worksheet_name=DEFAULT_WORKSHEET_NAME):
+    try:
+        gc = get_gspread_client()
+        sh = gc.open_by_key(spreadsheet_id)
+        worksheet = sh.worksheet(worksheet_name)
 
         existing_df = get_as_dataframe(worksheet).dropna(subset=['URL'])
         processed_urls = set(existing_df['URL'].tolist())
 
-        logging.info(f'✅ 取得済URL数: {len(processed_urls)}')
+        logging.info(f'✅ 取得済URL数: {len(processed_urls)}（{worksheet_name}）')
         return worksheet, existing_df, processed_urls
 
     except Exception as e:
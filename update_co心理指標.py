@@ -1,25 +1,112 @@
+import json
 import logging
 import warnings
 import numpy as np
 import google.generativeai as genai
-from gspread_dataframe import get_as_dataframe
 import os
 
+from co列型 import 状態, 欠損, load_traits, traits_to_cells, set_traits, excluded_mask, text_column
+from co入出力 import SheetTarget, drop_finished
+from coバリュー類似 import find_representatives
+
 
 # ============================================
 # Gemini 初期化
 # ============================================
+# PVQ / Big5 で共通の短いシステムプロンプト（毎回の本文には入れない）
+SYSTEM_PROMPT = (
+    "あなたは心理学の専門家です。企業の「バリュー」または「行動指針」の文章から、"
+    "指定された尺度の各項目を整数で推定し、JSON だけを返してください。"
+)
+
+# バリュー文に使うトークン数の上限（GEMINI_VALUE_TOKEN_BUDGET で変更）
+DEFAULT_VALUE_TOKEN_BUDGET = 1500
+
+
 def init_gemini():
     api_key = os.getenv("GEMINI_API_KEY")
     if not api_key:
         raise RuntimeError("環境変数 GEMINI_API_KEY が設定されていません")
     genai.configure(api_key=api_key)
-    return genai.GenerativeModel("gemini-3.5-flash")
+    return genai.GenerativeModel("gemini-3.5-flash", system_instruction=SYSTEM_PROMPT)
 
 
 gemini_model = None
 
 
+def value_token_budget():
+    """GEMINI_VALUE_TOKEN_BUDGET を読む（不正な値は各行の推定失敗にせず、起動時にエラーにする）"""
+    raw = os.getenv("GEMINI_VALUE_TOKEN_BUDGET", "")
+    if not raw:
+        return DEFAULT_VALUE_TOKEN_BUDGET
+    try:
+        budget = int(raw)
+    except ValueError:
+        budget = 0
+    if budget <= 0:
+        raise RuntimeError(f"環境変数 GEMINI_VALUE_TOKEN_BUDGET が不正です（正の整数）: {raw!r}")
+    return budget
+
+
+VALUE_TOKEN_BUDGET = value_token_budget()
+
+
+def truncate_value_text(value_text, budget=None):
+    """
+    トークン数を概算してバリュー文を予算内に切り詰める。
+    日本語は 1 文字 ≒ 1 トークン、ASCII は 4 文字 ≒ 1 トークンとして数える。
+    """
+    if budget is None:
+        budget = VALUE_TOKEN_BUDGET
+
+    text = str(value_text).strip()
+    used = 0.0
+    for i, ch in enumerate(text):
+        used += 0.25 if ch.isascii() else 1.0
+        if used > budget:
+            return text[:i]
+    return text
+
+
+def generate_trait_scores(instruction, traits, value_text, low, high, label):
+    """
+    JSON スキーマ（各項目が整数）を指定して Gemini に推定させる。
+    範囲外・欠けた項目は含めずに {項目: 値} を返す。
+    """
+    global gemini_model
+    if gemini_model is None:
+        gemini_model = init_gemini()
+
+    schema = {
+        "type": "object",
+        "properties": {t: {"type": "integer"} for t in traits},
+        "required": traits,
+    }
+    prompt = f"{instruction}\n---\n{truncate_value_text(value_text)}"
+
+    res = gemini_model.generate_content(
+        prompt,
+        generation_config=genai.GenerationConfig(
+            response_mime_type="application/json",
+            response_schema=schema,
+        ),
+    )
+
+    usage = res.usage_metadata
+    if usage:
+        logging.info(
+            f"🔢 {label} トークン: 入力 {usage.prompt_token_count} / 出力 {usage.candidates_token_count}"
+        )
+
+    data = json.loads(res.text)
+    scores = {}
+    for t in traits:
+        v = data.get(t)
+        if type(v) is int and low <= v <= high:   # JSON の true/false（bool）は除く
+            scores[t] = v
+    return scores
+
+
 # ============================================
 # PVQ 10項目
 # ============================================
@@ -28,58 +115,19 @@ pvq_traits = [
     "安全", "順応", "伝統", "博愛", "普遍主義"
 ]
 pvq_columns = [f"PVQ_{t}" for t in pvq_traits]
+pvq_ref_column = "PVQ参照元"   # スコアを流用した代表行の URL
 
 
 # ============================================
 # Gemini による PVQ 推定
 # ============================================
 def extract_pvq_scores(value_text):
-    global gemini_model
-    if gemini_model is None:
-        gemini_model = init_gemini()
-
-    prompt = f"""
-        あなたは心理学の専門家です。
-        以下の文章は、ある企業の「バリュー」または「行動指針」を要約したものです。
-        
-        Schwartzの10価値観（PVQ）理論に基づいて、この文章が各価値観をどの程度重視しているかを、1〜7で推定してください。
-        
-        出力形式（順番厳守）：
-        自己方向性: 数値
-        刺激: 数値
-        享楽: 数値
-        達成: 数値
-        権力: 数値
-        安全: 数値
-        順応: 数値
-        伝統: 数値
-        博愛: 数値
-        普遍主義: 数値
-        
-        ---
-        {value_text}
-        """
-
     try:
-        res = gemini_model.generate_content(prompt)
-        text = res.text.strip()
-        lines = text.splitlines()
-
-        scores = {}
-        for line in lines:
-            if ":" not in line:
-                continue
-            key, val = line.split(":", 1)
-            key = key.strip()
-            val = val.strip()
-
-            if key in pvq_traits:
-                try:
-                    scores[f"PVQ_{key}"] = int(val)
-                except:
-                    scores[f"PVQ_{key}"] = ""
-
-        return scores
+        scores = generate_trait_scores(
+            "Schwartzの10価値観（PVQ）について、この文章が各価値観を重視する度合いを1〜7で推定してください。",
+            pvq_traits, value_text, 1, 7, "PVQ",
+        )
+        return {f"PVQ_{t}": v for t, v in scores.items()}
 
     except Exception as e:
         warnings.warn(f"Gemini PVQ推定エラー: {e}")
@@ -92,68 +140,8 @@ def extract_pvq_scores(value_text):
 def update_co個人価値観(worksheet):
     logging.info("🧭 update_co個人価値観 開始")
 
-    df = get_as_dataframe(worksheet)
-    df = df.astype(object).fillna("")
-    
-    # PVQ列がなければ作成
-    for col in pvq_columns:
-        if col not in df.columns:
-            df[col] = ""
-
-    update_count = 0
-
-    for idx, row in df.iterrows():
-        company = row.get("会社名", "")
-        value_text = row.get("バリュー", "")
-
-        # すでに埋まっている行はスキップ（ログは出さない）
-        if all(str(row.get(col, "")).strip() not in ["", "対象外"] for col in pvq_columns):
-            continue
-
-        # 「対象外」処理（ログを出さない）
-        if company == "対象外" or value_text in ["対象外", "取得失敗", ""]:
-            for col in pvq_columns:
-                df.at[idx, col] = "対象外"
-            update_count += 1
-            continue
-
-        # ---------- PVQ 推定 ----------
-        scores = extract_pvq_scores(value_text)
-
-        if scores and any(scores.values()):
-            # 正常にスコアが返った場合
-            for col in pvq_columns:
-                df.at[idx, col] = scores.get(col, "")
-            update_count += 1
-            logging.info(f"📝 PVQ推定: {company}")
-        else:
-            # Gemini の推定が失敗した場合 → すべて「対象外」
-            for col in pvq_columns:
-                df.at[idx, col] = "対象外"
-            update_count += 1
-            logging.warning(f"⚠️ 推定失敗 → 対象外に設定: {company}")
-
-    df.replace([np.nan, np.inf, -np.inf], "", inplace=True)
-
-    # ============================================
-    # 列全体一括更新
-    # ============================================
-    def col_to_letter(index):
-        letters = ""
-        while index >= 0:
-            index, rem = divmod(index, 26)
-            letters = chr(65 + rem) + letters
-            index -= 1
-        return letters
-
-    for col in pvq_columns:
-        col_index = df.columns.get_loc(col)
-        col_letter = col_to_letter(col_index)
-
-        worksheet.update(
-            f"{col_letter}2:{col_letter}{len(df)+1}",
-            [[v] for v in df[col].tolist()]
-        )
+    target = SheetTarget(worksheet)
+    update_count = run_trait_stage("pvq", target, target.load())
 
     logging.info(f"📝 {update_count} 件のPVQスコアを更新しました")
     return f"{update_count} 件更新", 200
@@ -171,52 +159,16 @@ big5_traits = [
 ]
 
 big5_columns = big5_traits[:]   # そのまま列名に使う
+big5_ref_column = "Big5参照元"
 
 
 def extract_big_five_from_value(value_text):
     """バリュー文からBig Fiveを推定（2〜14の整数）"""
-    global gemini_model
-    if gemini_model is None:
-        gemini_model = init_gemini()
-
-    prompt = f"""
-        あなたは心理学者です。
-        以下は企業文化を示す「バリュー」または「行動指針」の要約です。
-        
-        これを書いた人物の Big Five（性格5因子）を推定し、
-        各因子を 2〜14 の整数値で返してください。
-        
-        出力形式（順番厳守）：
-        Extraversion: 数値
-        Agreeableness: 数値
-        Conscientiousness: 数値
-        Neuroticism: 数値
-        Openness: 数値
-        
-        ---
-        {value_text}
-        """
-
     try:
-        res = gemini_model.generate_content(prompt)
-        text = res.text.strip()
-        lines = text.splitlines()
-
-        scores = {}
-        for line in lines:
-            if ":" not in line:
-                continue
-            key, val = line.split(":", 1)
-            key = key.strip()
-            val = val.strip()
-
-            if key in big5_traits:
-                try:
-                    scores[key] = int(val)
-                except:
-                    scores[key] = ""
-
-        return scores
+        return generate_trait_scores(
+            "この文章を書いた人物の Big Five（性格5因子）の各因子を2〜14で推定してください。",
+            big5_traits, value_text, 2, 14, "Big5",
+        )
 
     except Exception as e:
         warnings.warn(f"Gemini Big5推定エラー: {e}")
@@ -229,68 +181,124 @@ def extract_big_five_from_value(value_text):
 def update_cobig5(worksheet):
     logging.info("🧭 update_cobig5 開始")
 
-    df = get_as_dataframe(worksheet)
-    df = df.astype(object).fillna("")
-
-    # Big5列がなければ作成
-    for col in big5_columns:
-        if col not in df.columns:
-            df[col] = ""
-
-    update_count = 0
+    target = SheetTarget(worksheet)
+    update_count = run_trait_stage("big5", target, target.load())
 
-    for idx, row in df.iterrows():
-        company = row.get("会社名", "")
-        value_text = row.get("バリュー", "")
+    logging.info(f"📝 {update_count} 件のBig Fiveスコアを更新しました")
+    return f"{update_count} 件更新", 200
 
-        # 既に全項目が埋まっている行はスキップ
-        if all(str(row.get(col, "")).strip() not in ["", "対象外"] for col in big5_columns):
-            continue
 
-        # 対象外の処理（ログ出さない）
-        if company == "対象外" or value_text in ["対象外", "取得失敗", ""]:
-            for col in big5_columns:
-                df.at[idx, col] = "対象外"
-            update_count += 1
+# ============================================================
+# PVQ / Big5 共通の推定処理（Flask の各ステージと backfill.py で共有）
+# ============================================================
+TRAIT_STAGES = {
+    "pvq": ("PVQ", pvq_columns, pvq_ref_column, extract_pvq_scores),
+    "big5": ("Big5", big5_columns, big5_ref_column, extract_big_five_from_value),
+}
+
+
+def run_trait_stage(stage, target, df, in_range=None, pool=None, chunk_size=None):
+    """
+    in_range（省略時は全行）の未完了行を推定し、変更した行だけを target に書き戻す。
+    chunk_size 行ずつリースして処理し（省略時は 1 回で LEASE_BATCH_SIZE 行まで）、
+    pool を渡すと Gemini 呼び出しを並列に実行する。更新件数を返す。
+    """
+    global gemini_model
+    label, columns, ref_column, extract = TRAIT_STAGES[stage]
+    target.add_columns(df, columns + [ref_column])
+
+    values, status = load_traits(df, columns)
+    urls = text_column(df, "URL").to_numpy()
+    texts = text_column(df, "バリュー").to_numpy()
+    companies = text_column(df, "会社名").to_numpy()
+    refs = text_column(df, ref_column).to_numpy()
+    sources = target.sources(df)
+    not_target = excluded_mask(df)
+    if in_range is None:
+        in_range = np.ones(len(df), dtype=bool)
+
+    def cells(rows):
+        out = {col: traits_to_cells(values, status, j, rows) for j, col in enumerate(columns)}
+        ref_cells = [None] * len(df)
+        for i in rows:
+            ref_cells[i] = [refs[i]]
+        out[ref_column] = ref_cells
+        return out
+
+    # 「対象外」はリースを取らずにまとめて設定する（Gemini を呼ばないので誰が書いても同じ）
+    pending = in_range & (status != 状態.完了)
+    excluded = pending & not_target
+    marked = excluded & ((status != 状態.対象外) | (values != 欠損).any(axis=1) | (refs != ""))
+    values[excluded] = 欠損
+    status[excluded] = 状態.対象外
+    refs[excluded] = ""
+    update_count = int(marked.sum())
+    if marked.any():
+        target.write(df, cells(np.flatnonzero(marked)), np.flatnonzero(marked))
+
+    # 似たバリュー文は代表行のスコアを流用する（代表行は必ず自分より前の行）
+    targets = pending & ~not_target
+    done = (status == 状態.完了) & ~not_target
+    rep = find_representatives(texts, reusable=done, pending=targets)
+
+    rows = np.flatnonzero(targets)
+    step = chunk_size or max(len(rows), 1)
+    mapper = pool.map if pool is not None else map
+
+    for start in range(0, len(rows), step):
+        candidates = np.zeros(len(df), dtype=bool)
+        candidates[rows[start:start + step]] = True
+        claimed = np.flatnonzero(
+            target.claim(stage, df, candidates, None if chunk_size is None else step)
+        )
+        if len(claimed) == 0:
             continue
 
-        # Gemini 推定
-        scores = extract_big_five_from_value(value_text)
-
-        if scores and any(scores.values()):
-            for col in big5_columns:
-                df.at[idx, col] = scores.get(col, "")
-            update_count += 1
-            logging.info(f"📝 Big5推定: {company}")
-
-        else:
-            # 推定失敗 → 全て対象外
-            for col in big5_columns:
-                df.at[idx, col] = "対象外"
-            update_count += 1
-            logging.warning(f"⚠️ Big5推定失敗 → 対象外に設定: {company}")
-
-    # 欠損・無限を除去
-    df.replace([np.nan, np.inf, -np.inf], "", inplace=True)
-
-    # Excel一括更新（PVQと同じ関数を利用）
-    def col_to_letter(index):
-        letters = ""
-        while index >= 0:
-            index, rem = divmod(index, 26)
-            letters = chr(65 + rem) + letters
-            index -= 1
-        return letters
-
-    for col in big5_columns:
-        col_index = df.columns.get_loc(col)
-        col_letter = col_to_letter(col_index)
-
-        worksheet.update(
-            f"{col_letter}2:{col_letter}{len(df) + 1}",
-            [[v] for v in df[col].tolist()]
+        # 他のワーカーが書き込み済みの行は除き、その結果は流用元として使う
+        fresh = drop_finished(
+            target, df, claimed, columns, load_traits, values, status, [ref_column]
         )
+        changed = np.setdiff1d(claimed, fresh)
+        refs[changed] = text_column(df, ref_column).to_numpy()[changed]
+        done[changed] = status[changed] == 状態.完了
+        claimed = fresh
+        if len(claimed) == 0:
+            continue
 
-    logging.info(f"📝 {update_count} 件のBig Fiveスコアを更新しました")
-    return f"{update_count} 件更新", 200
-
+        # 代表行が推定済みか、このチャンクで自分が推定する場合だけ流用する
+        claimed_set = set(claimed.tolist())
+        follows = {
+            i: rep[i] for i in claimed
+            if rep[i] != i and (done[rep[i]] or rep[i] in claimed_set)
+        }
+        own = [i for i in claimed if i not in follows]
+
+        # スレッドから同時に初期化しないよう先に作っておく
+        if own and gemini_model is None:
+            gemini_model = init_gemini()
+
+        for i, scores in zip(own, mapper(extract, texts[own])):
+            if scores and any(scores.values()):
+                set_traits(values, status, i, scores, columns)
+                logging.info(f"📝 {label}推定: {companies[i]}")
+            else:
+                # Gemini の推定が失敗した場合 → すべて「対象外」
+                values[i] = 欠損
+                status[i] = 状態.対象外
+                logging.warning(f"⚠️ {label}推定失敗 → 対象外に設定: {companies[i]}")
+            refs[i] = ""
+            done[i] = True
+
+        for i, r in follows.items():
+            values[i] = values[r]
+            status[i] = status[r]
+            # 代表行が別シートの行なら、URL にそのシートを添える
+            refs[i] = urls[r] if sources[r] == sources[i] else f"{urls[r]}（{sources[r]}）"
+            logging.info(f"📝 {label}流用: {companies[i]} ← {refs[i]}")
+
+        update_count += len(claimed)
+        target.write(df, cells(claimed), claimed)
+        if chunk_size is not None:
+            logging.info(f"📝 {stage}: {min(start + step, len(rows))} / {len(rows)} 行")
+
+    return update_count
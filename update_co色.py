@@ -4,12 +4,26 @@ from gspread_dataframe import get_as_dataframe
 from pdf2image import convert_from_bytes
 from sklearn.cluster import KMeans
 from PIL import Image
+from pypdf import PdfReader
+from pypdf.generic import ContentStream
+from io import BytesIO
 import requests
 import warnings
 import logging
 import re
 from gspread_formatting import format_cell_ranges, CellFormat, Color
 
+from concurrent.futures import as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from co列型 import 状態, 欠損, load_colors, colors_to_cells, pack_rgb, text_column
+from co入出力 import SheetTarget, drop_finished
+
+
+# PDF ダウンロード用の HTTP セッション（全シート・全行で接続を使い回す）
+http_session = requests.Session()
+http_session.headers.update({"User-Agent": "Mozilla/5.0"})
+
 
 # ============================================
 # グレー判定
@@ -24,39 +38,293 @@ def is_near_gray(rgb, threshold=30):
 
 
 # ============================================
-# PDF から主要色を抽出
+# ベクター PDF の塗り色を content stream から集める
 # ============================================
-def extract_main_colors_from_pdf(pdf_bytes, num_colors=2):
-    try:
-        images = convert_from_bytes(
-            pdf_bytes,
-            dpi=200,
-            first_page=1,
-            last_page=3,
-        )
-
-        all_pixels = []
+MAX_PAGES = 3
+RASTER_SIZE = 400   # ラスタライズ後に縮小するサイズ（400x400）
+
+FILL_OPS = {b"f", b"F", b"f*"}
+STROKE_OPS = {b"S", b"s"}
+FILL_STROKE_OPS = {b"B", b"B*", b"b", b"b*"}
+PAINT_OPS = FILL_OPS | STROKE_OPS | FILL_STROKE_OPS | {b"n"}
+TEXT_OPS = {b"Tj", b"TJ", b"'", b'"'}
+
+# 色空間 → 成分数（Gray / RGB / CMYK として読めるものだけ）
+DEVICE_COMPONENTS = {b"g": 1, b"G": 1, b"rg": 3, b"RG": 3, b"k": 4, b"K": 4}
+COLOR_SPACE_COMPONENTS = {
+    "/DeviceGray": 1, "/CalGray": 1, "/G": 1,
+    "/DeviceRGB": 3, "/CalRGB": 3, "/RGB": 3,
+    "/DeviceCMYK": 4, "/CMYK": 4,
+}
+
+
+def operand_rgb(operands, components):
+    """色演算子の数値オペランドを、成分数（Gray / RGB / CMYK）に従って 0〜255 の RGB にする"""
+    nums = [float(x) for x in operands if isinstance(x, (int, float))]
+    if components is None or len(nums) != components:
+        return None   # Separation / Indexed / パターン等は扱わない
+    if components == 1:
+        rgb = (nums[0],) * 3
+    elif components == 3:
+        rgb = tuple(nums)
+    else:
+        c, m, y, k = nums
+        rgb = ((1 - c) * (1 - k), (1 - m) * (1 - k), (1 - y) * (1 - k))
+    return tuple(int(round(min(max(v, 0.0), 1.0) * 255)) for v in rgb)
+
+
+def color_space_components(color_spaces, name):
+    """cs / CS で指定された色空間の成分数（Gray / RGB / CMYK 以外は None）"""
+    if name in COLOR_SPACE_COMPONENTS:
+        return COLOR_SPACE_COMPONENTS[name]
+    space = color_spaces.get(name) if color_spaces is not None else None
+    if space is None:
+        return None
+    space = space.get_object()
+    if not isinstance(space, list):
+        return COLOR_SPACE_COMPONENTS.get(space)
+    if space[0] == "/ICCBased":
+        n = space[1].get_object().get("/N")
+        return int(n) if n in (1, 3, 4) else None
+    return COLOR_SPACE_COMPONENTS.get(space[0])
+
+
+def text_length(operands):
+    """Tj / TJ / ' / " で描く文字数（TJ の配列は文字列部分だけ数える）"""
+    length = 0
+    for operand in operands:
+        if isinstance(operand, list):
+            length += sum(len(x) for x in operand if isinstance(x, (str, bytes)))
+        elif isinstance(operand, (str, bytes)):
+            length += len(operand)
+    return length
+
+
+def collect_vector_colors(reader, content, resources, scale, found, depth=0, colors=None):
+    """
+    content stream を走査し、塗り・線・文字の色と描画面積を found に (r, g, b, 面積) で追加する。
+    パスの面積は外接矩形、文字の面積は「文字数 × 0.5 em × 1 em」で近似し、
+    CTM とテキスト行列の行列式（scale）で拡大率を反映する。
+    Gray / RGB / CMYK 以外の色空間で塗った部分は数えない（ページごとラスタライズに回る）。
+    """
+    # (塗り色, 線の色, 塗りの成分数, 線の成分数)。フォームは呼び出し元の色を引き継ぐ
+    fill, stroke, fill_n, stroke_n = colors or ((0, 0, 0), (0, 0, 0), 1, 1)
+    line_width = 1.0
+    font_size = 0.0
+    render_mode = 0
+    text_scale = 1.0
+    stack = []
+    box = None
+
+    resources = resources.get_object() if resources is not None else None
+    xobjects = color_spaces = None
+    if resources is not None:
+        xobjects = resources.get("/XObject")
+        xobjects = xobjects.get_object() if xobjects is not None else None
+        color_spaces = resources.get("/ColorSpace")
+        color_spaces = color_spaces.get_object() if color_spaces is not None else None
+
+    if not isinstance(content, ContentStream):
+        content = ContentStream(content, reader)
+
+    def add_point(x, y):
+        nonlocal box
+        x, y = float(x), float(y)
+        if box is None:
+            box = [x, y, x, y]
+        else:
+            box = [min(box[0], x), min(box[1], y), max(box[2], x), max(box[3], y)]
+
+    def add(color, area):
+        if color is not None and area > 0:
+            found.append((*color, area))
+
+    for operands, op in content.operations:
+        if op == b"q":
+            stack.append((fill, stroke, fill_n, stroke_n, line_width, font_size, render_mode, scale))
+        elif op == b"Q" and stack:
+            fill, stroke, fill_n, stroke_n, line_width, font_size, render_mode, scale = stack.pop()
+        elif op == b"cm" and len(operands) == 6:
+            a, b, c, d = (float(v) for v in operands[:4])
+            scale *= abs(a * d - b * c)
+        elif op == b"w" and operands:
+            line_width = float(operands[0])
+
+        # ---- 色の設定（cs / CS で色空間を切り替え、sc / scn はその成分数で読む）
+        elif op in (b"g", b"rg", b"k"):
+            fill_n = DEVICE_COMPONENTS[op]
+            fill = operand_rgb(operands, fill_n)
+        elif op in (b"G", b"RG", b"K"):
+            stroke_n = DEVICE_COMPONENTS[op]
+            stroke = operand_rgb(operands, stroke_n)
+        elif op == b"cs" and operands:
+            fill_n = color_space_components(color_spaces, operands[0])
+            fill = (0, 0, 0) if fill_n else None
+        elif op == b"CS" and operands:
+            stroke_n = color_space_components(color_spaces, operands[0])
+            stroke = (0, 0, 0) if stroke_n else None
+        elif op in (b"sc", b"scn"):
+            fill = operand_rgb(operands, fill_n)
+        elif op in (b"SC", b"SCN"):
+            stroke = operand_rgb(operands, stroke_n)
+
+        # ---- パスの構築
+        elif op in (b"m", b"l") and len(operands) == 2:
+            add_point(*operands)
+        elif op in (b"c", b"v", b"y"):
+            for i in range(0, len(operands) - 1, 2):
+                add_point(operands[i], operands[i + 1])
+        elif op == b"re" and len(operands) == 4:
+            x, y, w, h = (float(v) for v in operands)
+            add_point(x, y)
+            add_point(x + w, y + h)
+
+        # ---- 描画
+        elif op in PAINT_OPS:
+            if box is not None:
+                width, height = box[2] - box[0], box[3] - box[1]
+                if op in FILL_OPS or op in FILL_STROKE_OPS:
+                    add(fill, width * height * scale)
+                if op in STROKE_OPS or op in FILL_STROKE_OPS:
+                    add(stroke, 2 * (width + height) * line_width * scale)
+            box = None
+
+        # ---- 文字（Tr: 0,2,4,6 は塗り、1,2,5,6 は線で描く）
+        elif op == b"BT":
+            text_scale = 1.0
+        elif op == b"Tm" and len(operands) == 6:
+            a, b, c, d = (float(v) for v in operands[:4])
+            text_scale = abs(a * d - b * c)
+        elif op == b"Tf" and len(operands) == 2:
+            font_size = float(operands[1])
+        elif op == b"Tr" and operands:
+            render_mode = int(operands[0])
+        elif op in TEXT_OPS:
+            area = text_length(operands) * 0.5 * font_size * font_size * text_scale * scale
+            if render_mode in (0, 2, 4, 6):
+                add(fill, area)
+            if render_mode in (1, 2, 5, 6):
+                add(stroke, area)
+
+        # ---- フォーム
+        elif op == b"Do" and xobjects is not None and operands:
+            xobj = xobjects.get(operands[0])
+            if xobj is None:
+                continue
+            xobj = xobj.get_object()
+            if xobj.get("/Subtype") == "/Form" and depth < 3:
+                a, b, c, d = (float(v) for v in xobj.get("/Matrix", [1, 0, 0, 1, 0, 0])[:4])
+                collect_vector_colors(
+                    reader, xobj, xobj.get("/Resources") or resources,
+                    scale * abs(a * d - b * c), found, depth + 1,
+                    (fill, stroke, fill_n, stroke_n),
+                )
+
+
+def weighted_main_colors(pixels, weights, num_colors):
+    """
+    重み付き KMeans で主要色を求め、重みの大きい順に HEX で返す。
+    色の種類が num_colors に満たないときは最も多い色を繰り返して num_colors 個にする
+    （KMeans で同じ色が複数の中心になっていたときと同じ結果）。
+    """
+    unique, inverse = np.unique(pixels, axis=0, return_inverse=True)
+    totals = np.bincount(inverse.ravel(), weights=weights)
+
+    if len(unique) <= num_colors:
+        centers = unique
+    else:
+        kmeans = KMeans(n_clusters=num_colors, random_state=0)
+        kmeans.fit(unique, sample_weight=totals)
+        centers = kmeans.cluster_centers_
+        totals = np.bincount(kmeans.labels_, weights=totals, minlength=num_colors)
 
-        for img in images:
-            img_resized = img.resize((400, 400)).convert("RGB")
-            arr = np.array(img_resized).reshape(-1, 3)
+    order = np.argsort(-totals)
+    colors = [f"#{r:02X}{g:02X}{b:02X}" for r, g, b in np.rint(centers[order]).astype(int)]
+    return colors + colors[:1] * (num_colors - len(colors))
 
-            arr = np.array([px for px in arr if not is_near_gray(px)], dtype=int)
 
-            if len(arr) > 0:
-                all_pixels.append(arr)
+# ============================================
+# PDF から主要色を抽出
+# ============================================
+def extract_main_colors_from_pdf(pdf_bytes, num_colors=2):
+    """
+    まず先頭ページの content stream からベクターの塗り色・文字色を集め（面積で重み付け）、
+    有彩色が見つからなかったページ（画像のみ・未対応の色空間など）は pdf2image でラスタライズする。
+    """
+    try:
+        pixels = []
+        weights = []
 
-        if not all_pixels:
+        try:
+            reader = PdfReader(BytesIO(pdf_bytes))
+            pages = reader.pages[:MAX_PAGES]
+        except Exception as e:
+            warnings.warn(f"PDF 解析失敗（ラスタライズで抽出）: {e}")
+            reader, pages = None, [None] * MAX_PAGES
+
+        raster_pages = []
+        page_areas = {}
+
+        for page_no, page in enumerate(pages, start=1):
+            if page is None:
+                raster_pages.append(page_no)
+                continue
+
+            page_areas[page_no] = float(page.mediabox.width) * float(page.mediabox.height)
+            content = page.get_contents()
+            if content is None:
+                continue   # 空白ページ
+
+            found = []
+            try:
+                collect_vector_colors(reader, content, page.get("/Resources"), 1.0, found)
+            except Exception:
+                found = []   # 解析できないページはラスタライズする
+
+            found = [f for f in found if not is_near_gray(f[:3])]
+            if found:
+                found = np.array(found)
+                pixels.append(found[:, :3].astype(int))
+                weights.append(found[:, 3])
+            else:
+                raster_pages.append(page_no)
+
+        # 連続するページは 1 回の pdf2image 呼び出しでまとめてラスタライズする
+        raster_pages = np.array(raster_pages, dtype=int)
+        runs = np.split(raster_pages, np.flatnonzero(np.diff(raster_pages) != 1) + 1)
+        for run in runs:
+            if len(run) == 0:
+                continue
+            try:
+                images = convert_from_bytes(
+                    pdf_bytes,
+                    dpi=200,
+                    first_page=int(run[0]),
+                    last_page=int(run[-1]),
+                )
+            except Exception as e:
+                # ベクターで集めた色は捨てない
+                warnings.warn(f"ラスタライズ失敗（{run[0]}〜{run[-1]} ページ）: {e}")
+                continue
+
+            for page_no, img in zip(run, images):
+                img_resized = img.resize((RASTER_SIZE, RASTER_SIZE)).convert("RGB")
+                arr = np.array(img_resized).reshape(-1, 3).astype(int)
+
+                r, g, b = arr[:, 0], arr[:, 1], arr[:, 2]
+                gray = (abs(r - g) < 30) & (abs(g - b) < 30) & (abs(r - b) < 30)
+                arr = arr[~gray]
+
+                # 1 ピクセルをページ面積の 1/(400*400) としてベクター色と重みを揃える
+                area = page_areas.get(page_no, RASTER_SIZE * RASTER_SIZE)
+                pixels.append(arr)
+                weights.append(np.full(len(arr), area / (RASTER_SIZE * RASTER_SIZE)))
+
+        pixels = np.vstack(pixels) if pixels else np.empty((0, 3), dtype=int)
+        if len(pixels) == 0:
             return []
 
-        full_array = np.vstack(all_pixels)
-        kmeans = KMeans(n_clusters=num_colors, random_state=0)
-        kmeans.fit(full_array)
-
-        centers = kmeans.cluster_centers_.astype(int)
-        hex_colors = [f"#{r:02X}{g:02X}{b:02X}" for r, g, b in centers]
-
-        return hex_colors
+        return weighted_main_colors(pixels, np.concatenate(weights), num_colors)
 
     except Exception as e:
         warnings.warn(f"色抽出失敗: {e}")
@@ -69,87 +337,140 @@ def extract_main_colors_from_pdf(pdf_bytes, num_colors=2):
 def update_co色番号(worksheet):
     logging.info("🖼️ update_co色番号 開始")
 
-    df = get_as_dataframe(worksheet)
-    df = df.astype(object).fillna("")
-    
-    # 色列がなければ作成
-    if "色1番号" not in df.columns:
-        df["色1番号"] = ""
-    if "色2番号" not in df.columns:
-        df["色2番号"] = ""
-
-    update_count = 0
-
-    for idx, row in df.iterrows():
-        url = row.get("URL", "")
-        company = row.get("会社名", "")
-        color1 = row.get("色1番号", "")
-        color2 = row.get("色2番号", "")
-
-        if not url or (color1 and color2):
-            continue
+    target = SheetTarget(worksheet)
+    update_count = run_color_stage(target, target.load())
 
-        if company == "対象外":
-            df.at[idx, "色1番号"] = "対象外"
-            df.at[idx, "色2番号"] = "対象外"
-            update_count += 1
-            continue
+    logging.info(f"📝 {update_count} 件の色番号を更新しました")
+    return f"{update_count} 件更新", 200
 
-        try:
-            response = requests.get(
-                url,
-                headers={"User-Agent": "Mozilla/5.0"},
-                timeout=15,
-            )
-
-            if response.status_code == 200:
-                colors = extract_main_colors_from_pdf(response.content)
-
-                if len(colors) >= 2:
-                    df.at[idx, "色1番号"] = colors[0]
-                    df.at[idx, "色2番号"] = colors[1]
-                    update_count += 1
-                    logging.info(f"🎨 抽出成功: {url}")
-                else:
-                    df.at[idx, "色1番号"] = "取得失敗"
-                    df.at[idx, "色2番号"] = "取得失敗"
-                    update_count += 1
-                    logging.warning(f"⚠️ 色抽出失敗: {url}")
 
-            else:
-                df.at[idx, "色1番号"] = "取得失敗"
-                df.at[idx, "色2番号"] = "取得失敗"
-                update_count += 1
-                logging.warning(f"⚠️ ダウンロード失敗: {url}")
+# ============================================
+# 色番号の抽出処理（Flask の update_co色番号 と backfill.py で共有）
+# ============================================
+COLOR_COLUMNS = ["色1番号", "色2番号"]
 
-        except Exception as e:
-            df.at[idx, "色1番号"] = "取得失敗"
-            df.at[idx, "色2番号"] = "取得失敗"
-            update_count += 1
-            logging.warning(f"❌ エラー: {e} → {url}")
 
-    df = df.replace([np.nan, np.inf, -np.inf], "")
+def download_pdf(url):
+    response = http_session.get(url, timeout=15)
+    if response.status_code != 200:
+        return None
+    return response.content
+
+
+def fetch_colors(urls, rows, downloads=None, extractors=None):
+    """
+    rows の PDF をダウンロードして色を抽出し、(行, 色 or None, 失敗理由) を順に返す。
+    プールを渡すとダウンロードはスレッド、色抽出はプロセスで並列に実行する。
+    色抽出そのものの失敗は extract_main_colors_from_pdf が [] で返すので、プロセスプール側の
+    例外は取得失敗にせず、その行は返さない（未処理のまま次回に回す）。
+    プールが壊れた場合（poppler の OOM など）は BrokenProcessPool をそのまま送出する。
+    """
+    if downloads is None:
+        for i in rows:
+            try:
+                content = download_pdf(urls[i])
+                if content is None:
+                    yield i, None, f"⚠️ ダウンロード失敗: {urls[i]}"
+                else:
+                    yield i, extract_main_colors_from_pdf(content), None
+            except Exception as e:
+                yield i, None, f"❌ エラー: {e} → {urls[i]}"
+        return
+
+    fetched = {downloads.submit(download_pdf, urls[i]): i for i in rows}
+    extracted = {}
+    for future in as_completed(fetched):
+        i = fetched[future]
+        try:
+            content = future.result()
+        except Exception as e:
+            yield i, None, f"❌ エラー: {e} → {urls[i]}"
+            continue
+        if content is None:
+            yield i, None, f"⚠️ ダウンロード失敗: {urls[i]}"
+            continue
+        if extractors is None:
+            yield i, extract_main_colors_from_pdf(content), None
+        else:
+            extracted[extractors.submit(extract_main_colors_from_pdf, content)] = i
 
-    # 列 index → A1 記法
-    def col_to_letter(index):
-        letters = ""
-        while index >= 0:
-            index, rem = divmod(index, 26)
-            letters = chr(65 + rem) + letters
-            index -= 1
-        return letters
-
-    for col in ["色1番号", "色2番号"]:
-        col_index = df.columns.get_loc(col)
-        col_letter = col_to_letter(col_index)
-
-        worksheet.update(
-            f"{col_letter}2:{col_letter}{len(df) + 1}",
-            [[v] for v in df[col].tolist()],
+    for future in as_completed(extracted):
+        i = extracted[future]
+        try:
+            colors = future.result()
+        except BrokenProcessPool:
+            raise
+        except Exception as e:
+            logging.warning(f"⚠️ 色抽出プロセスのエラー（未処理のまま）: {e} → {urls[i]}")
+            continue
+        yield i, colors, None
+
+
+def run_color_stage(target, df, in_range=None, downloads=None, extractors=None, chunk_size=None):
+    """
+    in_range（省略時は全行）の URL があって色が未処理の行を抽出し、変更した行だけを書き戻す。
+    chunk_size 行ずつリースして処理する（省略時は 1 回で LEASE_BATCH_SIZE 行まで）。更新件数を返す。
+    """
+    target.add_columns(df, COLOR_COLUMNS)
+
+    values, status = load_colors(df, COLOR_COLUMNS)
+    urls = text_column(df, "URL").to_numpy()
+    if in_range is None:
+        in_range = np.ones(len(df), dtype=bool)
+
+    def cells(rows):
+        return {col: colors_to_cells(values, status, j, rows) for j, col in enumerate(COLOR_COLUMNS)}
+
+    # URL があり、色が未処理の行だけを対象にする
+    pending = in_range & (status == 状態.未処理) & (urls != "")
+
+    # 会社名が「対象外」の行はリースを取らずにまとめて設定する
+    excluded = pending & (text_column(df, "会社名") == "対象外").to_numpy()
+    values[excluded] = 欠損
+    status[excluded] = 状態.対象外
+    update_count = int(excluded.sum())
+    if excluded.any():
+        target.write(df, cells(np.flatnonzero(excluded)), np.flatnonzero(excluded))
+
+    rows = np.flatnonzero(pending & ~excluded)
+    step = chunk_size or max(len(rows), 1)
+
+    for start in range(0, len(rows), step):
+        candidates = np.zeros(len(df), dtype=bool)
+        candidates[rows[start:start + step]] = True
+        claimed = np.flatnonzero(
+            target.claim("color", df, candidates, None if chunk_size is None else step)
         )
+        if len(claimed) == 0:
+            continue
 
-    logging.info(f"📝 {update_count} 件の色番号を更新しました")
-    return f"{update_count} 件更新", 200
+        # 他のワーカーが書き込み済みの行はダウンロードしない
+        claimed = drop_finished(target, df, claimed, COLOR_COLUMNS, load_colors, values, status)
+        if len(claimed) == 0:
+            continue
+
+        # 結果が出た行だけを書き戻す（プールが壊れて中断しても、それまでの結果は残す）
+        finished = []
+        try:
+            for i, colors, error in fetch_colors(urls, claimed, downloads, extractors):
+                if colors is not None and len(colors) >= 2:
+                    values[i] = [pack_rgb(colors[0]), pack_rgb(colors[1])]
+                    status[i] = 状態.完了
+                    logging.info(f"🎨 抽出成功: {urls[i]}")
+                else:
+                    values[i] = 欠損
+                    status[i] = 状態.取得失敗
+                    logging.warning(error or f"⚠️ 色抽出失敗: {urls[i]}")
+                finished.append(i)
+        finally:
+            finished = np.sort(np.array(finished, dtype=int))
+            update_count += len(finished)
+            if len(finished):
+                target.write(df, cells(finished), finished)
+        if chunk_size is not None:
+            logging.info(f"🎨 color: {min(start + step, len(rows))} / {len(rows)} 行")
+
+    return update_count
 
 
 # ============================================
@@ -176,8 +497,7 @@ def update_co色(worksheet):
     logging.info("🎨 update_co色（塗りつぶし）開始")
 
     df = get_as_dataframe(worksheet)
-    df = df.astype(object).fillna("")
-    
+
     start_row = 2
 
     color_map = {
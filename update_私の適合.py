@@ -1,14 +1,14 @@
-from google.oauth2 import service_account
 import gspread
 from gspread_dataframe import get_as_dataframe, set_with_dataframe
 from gspread_formatting import format_cell_ranges, CellFormat, Color
-import pandas as pd
 import numpy as np
 import logging
 import re
 from matplotlib.colors import to_rgb
 from sklearn.preprocessing import MinMaxScaler
 
+from co列型 import 状態, 欠損, load_traits, load_colors, unpack_rgb, text_column
+
 
 def hex_to_color(hex_str):
     if (
@@ -31,25 +31,15 @@ def col_to_letter(index):
     return letters
 
 
-def update_私の適合(worksheet):
+def update_私の適合(worksheet, output_sheet_name="相性スコア"):
 
     logging.info("🔍 update_私の適合 開始")
 
-    # ---- 出力スプレッドシート指定
-    SPREADSHEET_ID = "18Sb4CcAE5JPFeufHG97tLZz9Uj_TvSGklVQQhoFF28w"
-    OUTPUT_SHEET_NAME = "相性スコア"
+    # ---- 出力先は入力と同じスプレッドシートの別シート
+    OUTPUT_SHEET_NAME = output_sheet_name
 
     try:
-        # ---- サービスアカウント認証（統一！）
-        creds = service_account.Credentials.from_service_account_file(
-            "/secrets/service-account-json",
-            scopes=[
-                "https://www.googleapis.com/auth/spreadsheets",
-                "https://www.googleapis.com/auth/drive",
-            ],
-        )
-        gc = gspread.authorize(creds)
-        sh = gc.open_by_key(SPREADSHEET_ID)
+        sh = worksheet.spreadsheet
 
         try:
             target_ws = sh.worksheet(OUTPUT_SHEET_NAME)
@@ -57,8 +47,8 @@ def update_私の適合(worksheet):
             target_ws = sh.add_worksheet(title=OUTPUT_SHEET_NAME, rows=1000, cols=30)
 
     except Exception as e:
-        logging.error(f"❌ Google 認証エラー: {e}")
-        return f"認証エラー: {e}", 500
+        logging.error(f"❌ 出力シート取得エラー: {e}")
+        return f"出力シート取得エラー: {e}", 500
 
     # ---- ユーザー設定値
     my_bigfive = {
@@ -91,53 +81,47 @@ def update_私の適合(worksheet):
     my_bigfive_vec = np.array([my_bigfive[t] for t in bigfive_traits])
     my_pvq_vec = np.array([my_pvq[t] for t in pvq_traits])
 
-    # ---- 入力データ
+    # ---- 入力データ（型付き配列に変換）
     df = get_as_dataframe(worksheet)
-    df = df.astype(object).fillna('')
-    
-    # 数値へ変換
-    for col in bigfive_traits + pvq_traits:
-        df[col] = pd.to_numeric(df.get(col, pd.Series(dtype=float)), errors="coerce")
+
+    b5_values, b5_status = load_traits(df, bigfive_traits)
+    pvq_values, pvq_status = load_traits(df, pvq_traits)
+    color_values, color_status = load_colors(df, ["色1番号", "色2番号"])
+    company = text_column(df, "会社名")
+    value = text_column(df, "バリュー")
 
     # ---- 有効データ抽出（※ 色番号を使う）
-    valid_rows = df[
-        (df.get("会社名", "") != "")
-        & (df.get("会社名", "") != "対象外")
-        & (df.get("バリュー", "") != "")
-        & df[bigfive_traits + pvq_traits].notnull().all(axis=1)
-        & (df.get("色1番号", "") != "")
-        & (df.get("色2番号", "") != "")
-    ].copy()
-
-    if len(valid_rows) == 0:
+    valid = (
+        ((company != "") & (company != "対象外") & (value != "")).to_numpy()
+        & (b5_status == 状態.完了)
+        & (pvq_status == 状態.完了)
+        & (color_status != 状態.未処理)
+    )
+
+    if not valid.any():
         return "⚠️ 有効なデータがありません", 200
 
-    # ---- スコア計算
-    def compute_bigfive_score(row):
-        vec = np.array([row[t] for t in bigfive_traits], dtype=float)
-        return 1 / (1 + np.linalg.norm(my_bigfive_vec - vec))
+    valid_rows = df[valid].copy()
 
-    def compute_pvq_score(row):
-        vec = np.array([row[t] for t in pvq_traits], dtype=float)
-        return 1 / (1 + np.linalg.norm(my_pvq_vec - vec))
+    # ---- スコア計算（行単位ではなく配列でまとめて計算）
+    b5_vecs = b5_values[valid].astype(float)
+    pvq_vecs = pvq_values[valid].astype(float)
 
-    def compute_color_score(row):
-        try:
-            c1 = np.array(to_rgb(row["色1番号"]))
-            c2 = np.array(to_rgb(row["色2番号"]))
-            fav = np.array(to_rgb(favorite_color))
-            unfav = np.array(to_rgb(unfavorite_color))
+    valid_rows["B5相性スコア_そのまま"] = 1 / (1 + np.linalg.norm(my_bigfive_vec - b5_vecs, axis=1))
+    valid_rows["PVQ相性スコア_そのまま"] = 1 / (1 + np.linalg.norm(my_pvq_vec - pvq_vecs, axis=1))
 
-            sim_fav = max(1 - np.linalg.norm(c1 - fav), 1 - np.linalg.norm(c2 - fav))
-            sim_unfav = max(1 - np.linalg.norm(c1 - unfav), 1 - np.linalg.norm(c2 - unfav))
+    # 色は 2 色とも有効なカラーコードのときだけ計算し、それ以外は 0
+    colors = color_values[valid]
+    rgb = unpack_rgb(colors)
+    fav = np.array(to_rgb(favorite_color))
+    unfav = np.array(to_rgb(unfavorite_color))
 
-            return sim_fav - sim_unfav
-        except:
-            return 0
+    sim_fav = (1 - np.linalg.norm(rgb - fav, axis=-1)).max(axis=1)
+    sim_unfav = (1 - np.linalg.norm(rgb - unfav, axis=-1)).max(axis=1)
 
-    valid_rows["B5相性スコア_そのまま"] = valid_rows.apply(compute_bigfive_score, axis=1)
-    valid_rows["PVQ相性スコア_そのまま"] = valid_rows.apply(compute_pvq_score, axis=1)
-    valid_rows["色相性スコア_そのまま"] = valid_rows.apply(compute_color_score, axis=1)
+    valid_rows["色相性スコア_そのまま"] = np.where(
+        (colors != 欠損).all(axis=1), sim_fav - sim_unfav, 0.0
+    )
 
     # ---- 正規化
     scaler = MinMaxScaler()
@@ -185,8 +169,7 @@ def update_私の適合(worksheet):
 
     # ---- 色塗り
     df_out = get_as_dataframe(target_ws)
-    df = df.astype(object).fillna('')
-    
+
     color_map = {
         "色1番号": "色1",
         "色2番号": "色2",